@@ -5,18 +5,74 @@ Generates a TrueType font with SBIX (bitmap emoji) tables from PNG images.
 """
 
 import os
-import glob
+import io
+import argparse
+import time
+import hashlib
+import struct
+import threading
+import traceback
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from fontTools.fontBuilder import FontBuilder
+from fontTools.ttLib import newTable
+from fontTools.ttLib.tables import sbixStrike, sbixGlyph
+from fontTools.ttLib.tables._g_l_y_f import Glyph
 from PIL import Image
 
+try:
+    import pyvips
+except (ImportError, OSError):
+    # pyvips is optional (OSError means libvips itself is missing);
+    # OpenCV or Pillow do the resizing when it's unavailable
+    pyvips = None
+
+try:
+    import cv2
+    import numpy as np
+except ImportError:
+    # OpenCV is optional; Pillow does the resizing when it's missing
+    cv2 = None
+
+# Library used to resize images, part of the cache key since the
+# bitmaps differ slightly between them
+if pyvips is not None:
+    RESIZE_BACKEND = "pyvips"
+elif cv2 is not None:
+    RESIZE_BACKEND = "opencv"
+else:
+    RESIZE_BACKEND = "pillow"
+
+# Fast DEFLATE level; bitmap size matters far less than build time.
+# Pillow 12 wheels already compress with zlib-ng and libvips saves PNGs
+# with libspng, so no separate encoder library is needed
+PNG_COMPRESS_LEVEL = 1
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# get_image_size results, keyed by (path, mtime)
+_image_sizes = {}
+
+# Per-thread scratch state, see encode_png
+_thread_local = threading.local()
+
+# Resized bitmaps are cached here so rebuilds skip resizing and encoding
+CACHE_DIR = ".fontaku_cache"
+# Bump whenever the generated bitmaps change to invalidate old cache entries
+CACHE_VERSION = 3
+
 
 def get_image_files(images_dir="images"):
     """Get all PNG files from the images directory and sort them by Unicode codepoint."""
-    png_files = glob.glob(os.path.join(images_dir, "U+*.png"))
-    # Sort by the hex value in the filename
-    png_files.sort(key=lambda x: int(Path(x).stem.replace("U+", ""), 16))
-    return png_files
+    entries = []
+    with os.scandir(images_dir) as it:
+        for entry in it:
+            name = entry.name
+            if name.startswith("U+") and name.endswith(".png"):
+                # Parse the hex value in the filename once, for sorting
+                entries.append((int(name[2:-4], 16), entry.path))
+    entries.sort()
+    return [path for _, path in entries]
 
 
 def parse_codepoint(filename):
@@ -28,8 +84,6 @@ def parse_codepoint(filename):
 
 def create_empty_glyph(glyphSet):
     """Create an empty glyph outline for use in the font."""
-    from fontTools.ttLib.tables._g_l_y_f import Glyph
-
     glyph = Glyph()
     glyph.numberOfContours = 0
     glyph.xMin = glyph.yMin = glyph.xMax = glyph.yMax = 0
@@ -43,50 +97,235 @@ def read_png_data(png_path):
 
 
 def get_image_size(png_path):
-    """Get the dimensions of a PNG image."""
-    with Image.open(png_path) as img:
-        return img.size
+    """Get the dimensions of a PNG image.
+    Reads them straight from the IHDR chunk instead of opening the image."""
+    key = (png_path, os.stat(png_path).st_mtime_ns)
+    if key not in _image_sizes:
+        with open(png_path, "rb") as f:
+            header = f.read(24)
+        if header[:8] == PNG_SIGNATURE and header[12:16] == b"IHDR":
+            _image_sizes[key] = struct.unpack(">II", header[16:24])
+        else:
+            # Not a PNG, let Pillow figure it out
+            with Image.open(png_path) as img:
+                _image_sizes[key] = img.size
+    return _image_sizes[key]
+
+
+def fit_to_canvas(img, ppem):
+    """Resize an image to the specified ppem size.
+    Maintains aspect ratio and centers the image in a square RGBA canvas."""
+    # Let the JPEG decoder shrink the image while decoding; other formats
+    # always decode at full resolution
+    if img.format in ("JPEG", "MPO"):
+        img.draft("RGB", (ppem, ppem))
+
+    # Normalize to RGBA once so everything below can assume it
+    if img.mode != "RGBA":
+        img = img.convert("RGBA")
+
+    # Get original dimensions
+    orig_width, orig_height = img.size
+
+    # Calculate the size maintaining aspect ratio
+    # The image should fit within ppem x ppem
+    scale = ppem / max(orig_width, orig_height)
+    new_width = int(orig_width * scale)
+    new_height = int(orig_height * scale)
+
+    # Resize the image, box-reducing large sources to within 2x of the
+    # target first so Lanczos has far fewer source pixels to convolve
+    resized = img.resize(
+        (new_width, new_height), Image.Resampling.LANCZOS, reducing_gap=2.0
+    )
+
+    # Square images fill the whole canvas, no need to paste them
+    if resized.size == (ppem, ppem):
+        return resized
+
+    # Create a square canvas and center the resized image. The canvas is
+    # fully transparent, so pasting without a mask keeps the source alpha
+    canvas = Image.new("RGBA", (ppem, ppem), (0, 0, 0, 0))
+    x_offset = (ppem - new_width) // 2
+    y_offset = (ppem - new_height) // 2
+    canvas.paste(resized, (x_offset, y_offset))
+    return canvas
+
+
+def encode_png(img):
+    """Encode an image as PNG and return its binary data."""
+    # Reuse one buffer per thread instead of allocating one per bitmap
+    buffer = getattr(_thread_local, "png_buffer", None)
+    if buffer is None:
+        buffer = _thread_local.png_buffer = io.BytesIO()
+    buffer.seek(0)
+    buffer.truncate()
+    img.save(buffer, format="PNG", optimize=False, compress_level=PNG_COMPRESS_LEVEL)
+    return buffer.getvalue()
 
 
 def resize_image_to_ppem(png_path, ppem):
     """Resize a PNG image to the specified ppem size and return PNG data.
     Maintains aspect ratio and centers the image in a square canvas."""
-    import io
+    with Image.open(png_path) as img:
+        return encode_png(fit_to_canvas(img, ppem))
+
+
+def make_pyramid(png_path, sizes=(256, 128, 64, 32)):
+    """Resize a PNG image to every size in sizes and return {ppem: PNG data}.
+    Only the largest size is resized from the source; each smaller size is
+    downscaled from the previous one, which is much cheaper for big sources."""
+    sizes = sorted(sizes, reverse=True)
+    if pyvips is not None:
+        return _make_pyramid_vips(png_path, sizes)
+    if cv2 is not None:
+        return _make_pyramid_cv2(png_path, sizes)
+
+    pyramid = {}
 
     with Image.open(png_path) as img:
-        # Get original dimensions
-        orig_width, orig_height = img.size
+        canvas = fit_to_canvas(img, sizes[0])
+    pyramid[sizes[0]] = encode_png(canvas)
+
+    for ppem in sizes[1:]:
+        canvas = canvas.resize((ppem, ppem), Image.Resampling.LANCZOS)
+        pyramid[ppem] = encode_png(canvas)
+
+    return pyramid
+
+
+def _make_pyramid_vips(png_path, sizes):
+    """pyvips implementation of make_pyramid, sizes must be in descending order.
+    libvips streams the source through the resize instead of decoding it
+    fully into memory first."""
+    ppem = sizes[0]
+    pyramid = {}
+
+    # Fit within ppem x ppem, maintaining aspect ratio
+    img = pyvips.Image.thumbnail(png_path, ppem, height=ppem)
+    img = img.colourspace("srgb")
+    if not img.hasalpha():
+        img = img.bandjoin(255)
+
+    # Center the resized image in a transparent square canvas
+    img = img.embed(
+        (ppem - img.width) // 2,
+        (ppem - img.height) // 2,
+        ppem,
+        ppem,
+        extend="background",
+        background=[0, 0, 0, 0],
+    )
+    # Render once, the smaller sizes are all downscaled from it
+    img = img.copy_memory()
+    pyramid[ppem] = img.write_to_buffer(".png", compression=PNG_COMPRESS_LEVEL)
+
+    for ppem in sizes[1:]:
+        img = img.thumbnail_image(ppem, height=ppem).copy_memory()
+        pyramid[ppem] = img.write_to_buffer(".png", compression=PNG_COMPRESS_LEVEL)
+
+    return pyramid
 
-        # Calculate the size maintaining aspect ratio
-        # The image should fit within ppem x ppem
-        scale = ppem / max(orig_width, orig_height)
-        new_width = int(orig_width * scale)
-        new_height = int(orig_height * scale)
 
-        # Resize the image
-        resized = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
+def _make_pyramid_cv2(png_path, sizes):
+    """OpenCV implementation of make_pyramid, sizes must be in descending order.
+    Uses INTER_AREA since OpenCV's Lanczos doesn't antialias when shrinking."""
+    ppem = sizes[0]
+    pyramid = {}
 
-        # Create a square canvas and center the resized image
-        canvas = Image.new("RGBA", (ppem, ppem), (0, 0, 0, 0))
+    with Image.open(png_path) as img:
+        if img.format in ("JPEG", "MPO"):
+            img.draft("RGB", (ppem, ppem))
+        # Resample with premultiplied alpha like Pillow does, otherwise
+        # transparent pixels bleed dark fringes into the edges
+        arr = np.asarray(img.convert("RGBA").convert("RGBa"))
+
+    # Fit within ppem x ppem, maintaining aspect ratio
+    orig_height, orig_width = arr.shape[:2]
+    scale = ppem / max(orig_width, orig_height)
+    new_width = int(orig_width * scale)
+    new_height = int(orig_height * scale)
+    resized = cv2.resize(arr, (new_width, new_height), interpolation=cv2.INTER_AREA)
+
+    # Center the resized image in a transparent square canvas. The canvas
+    # starts zeroed, so a plain slice copy equals compositing over it, and
+    # square images fill it entirely so they need no canvas at all
+    if (new_width, new_height) == (ppem, ppem):
+        canvas = resized
+    else:
+        canvas = np.zeros((ppem, ppem, 4), np.uint8)
         x_offset = (ppem - new_width) // 2
         y_offset = (ppem - new_height) // 2
-        canvas.paste(
-            resized, (x_offset, y_offset), resized if resized.mode == "RGBA" else None
-        )
+        rows = slice(y_offset, y_offset + new_height)
+        cols = slice(x_offset, x_offset + new_width)
+        canvas[rows, cols] = resized
+    pyramid[ppem] = encode_png(_premultiplied_to_image(canvas))
+
+    for ppem in sizes[1:]:
+        canvas = cv2.resize(canvas, (ppem, ppem), interpolation=cv2.INTER_AREA)
+        pyramid[ppem] = encode_png(_premultiplied_to_image(canvas))
 
-        # Save to bytes
-        buffer = io.BytesIO()
-        canvas.save(buffer, format="PNG")
-        return buffer.getvalue()
+    return pyramid
 
 
-def build_font(image_files, output_path="Fontaku.ttf"):
+def _premultiplied_to_image(arr):
+    """Convert a premultiplied RGBa array back to a straight RGBA image."""
+    height, width = arr.shape[:2]
+    return Image.frombuffer("RGBa", (width, height), arr).convert("RGBA")
+
+
+def _cache_paths(png_path, sizes):
+    """Get the cache file paths for a source image, as {ppem: path}."""
+    stat = os.stat(png_path)
+    prefix = (
+        f"{CACHE_VERSION}:{RESIZE_BACKEND}:{os.path.abspath(png_path)}:"
+        f"{stat.st_mtime_ns}:{stat.st_size}"
+    )
+    paths = {}
+    for ppem in sizes:
+        digest = hashlib.sha1(f"{prefix}:{ppem}".encode()).hexdigest()
+        paths[ppem] = os.path.join(CACHE_DIR, f"{digest}.png")
+    return paths
+
+
+def cached_pyramid(png_path, sizes=(256, 128, 64, 32)):
+    """Same as make_pyramid, but reuses PNG data cached by a previous build.
+    Cache entries are keyed on the source file's mtime and size, so editing
+    an image invalidates them."""
+    paths = _cache_paths(png_path, sizes)
+    try:
+        return {ppem: read_png_data(path) for ppem, path in paths.items()}
+    except FileNotFoundError:
+        pass
+
+    pyramid = make_pyramid(png_path, sizes)
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    for ppem, png_data in pyramid.items():
+        # Write to a temporary file first so an interrupted build never
+        # leaves a truncated entry behind
+        tmp_path = f"{paths[ppem]}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(png_data)
+        os.replace(tmp_path, paths[ppem])
+
+    return pyramid
+
+
+def _pyramid_worker(task):
+    """Build the strike pyramid for one image in a worker process."""
+    img_file, strike_sizes = task
+    return cached_pyramid(img_file, strike_sizes)
+
+
+def build_font(image_files, output_path="Fontaku.ttf", verbose=False):
     """Build the TrueType font with SBIX tables.
     Maps images to standard emoji codepoints starting at U+1F600.
 
     Args:
         image_files: List of PNG image file paths
         output_path: Output font file path
+        verbose: Print every codepoint to glyph mapping
     """
 
     if not image_files:
@@ -98,29 +337,29 @@ def build_font(image_files, output_path="Fontaku.ttf"):
     # Apple uses 800 units per em (not 1000!)
     fb = FontBuilder(unitsPerEm=800, isTTF=True)
 
-    # Build glyph list and cmap
-    glyph_order = [".notdef"]
-    cmap = {}
-
     # Standard emoji codepoints starting from U+1F600 (grinning face)
     emoji_codepoints_start = 0x1F600
 
-    for i, img_file in enumerate(image_files):
-        # Map to standard emoji codepoints
-        codepoint = emoji_codepoints_start + i
-        glyph_name = f"uni{codepoint:04X}"
-        glyph_order.append(glyph_name)
-        cmap[codepoint] = glyph_name
-        print(f"  Mapping U+{codepoint:04X} to {glyph_name}")
+    # Build glyph list and cmap, mapping images to standard emoji codepoints
+    codepoints = range(
+        emoji_codepoints_start, emoji_codepoints_start + len(image_files)
+    )
+    emoji_glyph_names = [f"uni{codepoint:04X}" for codepoint in codepoints]
+    glyph_order = [".notdef", *emoji_glyph_names]
+    cmap = dict(zip(codepoints, emoji_glyph_names))
+
+    if verbose:
+        for codepoint, glyph_name in cmap.items():
+            print(f"  Mapping U+{codepoint:04X} to {glyph_name}")
 
     fb.setupGlyphOrder(glyph_order)
     fb.setupCharacterMap(cmap)
 
     # Setup glyf table with empty outlines (for TrueType)
     # Even though we're using bitmaps, we need glyph outlines
-    glyphs = {}
-    for glyph_name in glyph_order:
-        glyphs[glyph_name] = create_empty_glyph(None)
+    # The outlines are all identical, so they share a single empty glyph
+    empty_glyph = create_empty_glyph(None)
+    glyphs = dict.fromkeys(glyph_order, empty_glyph)
 
     fb.setupGlyf(glyphs)
 
@@ -129,19 +368,13 @@ def build_font(image_files, output_path="Fontaku.ttf"):
     # This is what makes emoji properly centered!
     emoji_advance_width = 800
 
-    metrics = {}
-    for glyph_name in glyph_order:
-        if glyph_name == ".notdef":
-            metrics[glyph_name] = (500, 0)  # width, left side bearing
-        else:
-            # Advance width = units per em for proper centering
-            metrics[glyph_name] = (emoji_advance_width, 0)
+    # Advance width = units per em for proper centering
+    metrics = dict.fromkeys(emoji_glyph_names, (emoji_advance_width, 0))
+    metrics[".notdef"] = (500, 0)  # width, left side bearing
 
     fb.setupHorizontalMetrics(metrics)
 
     # Set basic font info
-    import time
-
     timestamp = int(time.time())
     fb.setupHead(unitsPerEm=800, created=timestamp, modified=timestamp)
 
@@ -179,9 +412,6 @@ def build_font(image_files, output_path="Fontaku.ttf"):
     font = fb.font
 
     # Setup SBIX table with bitmap data manually
-    from fontTools.ttLib import newTable
-    from fontTools.ttLib.tables import sbixStrike, sbixGlyph
-
     sbix = newTable("sbix")
     sbix.version = 1
     sbix.flags = 1
@@ -190,6 +420,13 @@ def build_font(image_files, output_path="Fontaku.ttf"):
     # Define multiple strike sizes for different display resolutions
     strike_sizes = [32, 64, 128, 256]
 
+    # Resize every image to all strike sizes up front; each image is
+    # independent so they can be spread across all CPU cores
+    print(f"\n  Resizing images with {RESIZE_BACKEND}...")
+    tasks = [(img_file, strike_sizes) for img_file in image_files]
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        pyramids = list(executor.map(_pyramid_worker, tasks, chunksize=4))
+
     print("\n  Creating SBIX strikes...")
     for ppem in strike_sizes:
         print(f"    Strike {ppem} ppem")
@@ -199,38 +436,53 @@ def build_font(image_files, output_path="Fontaku.ttf"):
         strike.glyphs = {}
 
         # Add empty .notdef glyph
-        notdef_glyph = sbixGlyph.Glyph()
-        notdef_glyph.glyphName = ".notdef"
-        notdef_glyph.graphicType = "png "
-        notdef_glyph.originOffsetX = 0
-        notdef_glyph.originOffsetY = 0
-        notdef_glyph.imageData = b""
-        strike.glyphs[".notdef"] = notdef_glyph
+        strike.glyphs[".notdef"] = sbixGlyph.Glyph(
+            glyphName=".notdef",
+            graphicType="png ",
+            originOffsetX=0,
+            originOffsetY=0,
+            imageData=b"",
+        )
+
+        # Calculate origin offsets for proper centering
+        # The bitmap is placed relative to the glyph's origin point
+        # X offset: center horizontally within advance width
+        # Y offset: position so the image is vertically centered
+        # Since we're using 800 units per em and the bitmap is ppem pixels,
+        # we need to scale appropriately. Both only depend on ppem.
+        origin_x = 0  # Already centered in resize function
+        # Vertical centering: descender offset
+        origin_y = int(-250 * ppem / 800)
+
+        # First glyph using each bitmap in this strike, keyed by PNG data
+        bitmap_owners = {}
 
         # Add emoji glyphs
         for i, img_file in enumerate(image_files):
             glyph_name = glyph_order[i + 1]  # +1 to skip .notdef
-
-            # Resize image to match ppem size
-            png_data = resize_image_to_ppem(img_file, ppem)
+            png_data = pyramids[i][ppem]  # Already resized to match ppem size
+
+            # Identical bitmaps are stored once, later glyphs reference the
+            # first one with a "dupe" record instead of repeating the data
+            owner = bitmap_owners.setdefault(png_data, glyph_name)
+            if owner != glyph_name:
+                strike.glyphs[glyph_name] = sbixGlyph.Glyph(
+                    glyphName=glyph_name,
+                    graphicType="dupe",
+                    referenceGlyphName=owner,
+                    originOffsetX=origin_x,
+                    originOffsetY=origin_y,
+                )
+                continue
 
             # Create SBIX glyph
-            glyph = sbixGlyph.Glyph()
-            glyph.glyphName = glyph_name
-            glyph.graphicType = "png "
-            # Calculate origin offsets for proper centering
-            # The bitmap is placed relative to the glyph's origin point
-            # X offset: center horizontally within advance width
-            # Y offset: position so the image is vertically centered
-            # Since we're using 800 units per em and the bitmap is ppem pixels,
-            # we need to scale appropriately
-            scale_factor = 800 / ppem
-            glyph.originOffsetX = 0  # Already centered in resize function
-            # Vertical centering: descender offset
-            glyph.originOffsetY = int(-250 / scale_factor)
-            glyph.imageData = png_data
-
-            strike.glyphs[glyph_name] = glyph
+            strike.glyphs[glyph_name] = sbixGlyph.Glyph(
+                glyphName=glyph_name,
+                graphicType="png ",
+                originOffsetX=origin_x,
+                originOffsetY=origin_y,
+                imageData=png_data,
+            )
 
         sbix.strikes[ppem] = strike
 
@@ -246,6 +498,12 @@ def build_font(image_files, output_path="Fontaku.ttf"):
 
 def main():
     """Main entry point."""
+    parser = argparse.ArgumentParser(description="Fontaku Font Generator")
+    parser.add_argument(
+        "-v", "--verbose", action="store_true", help="print every glyph mapping"
+    )
+    args = parser.parse_args()
+
     print("Fontaku Font Generator")
     print("=" * 50)
     print("Generating emoji font with standard Unicode codepoints")
@@ -267,7 +525,7 @@ def main():
 
     # Build the font
     try:
-        output_file = build_font(image_files, "Fontaku.ttf")
+        output_file = build_font(image_files, "Fontaku.ttf", verbose=args.verbose)
         print("\n" + "=" * 50)
         print("✓ Font generation complete!")
         print(f"\nYou can now install '{output_file}' on macOS by:")
@@ -280,8 +538,6 @@ def main():
         print("\n💡 Tip: Your emojis will appear in the emoji picker!")
     except Exception as e:
         print(f"\nError generating font: {e}")
-        import traceback
-
         traceback.print_exc()
 
 